@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import ffmpeg
+import rich
+from rich.align import Align
+from rich.table import Table
+
+import distributed
+
+HOST = "127.0.0.1"
+SEGMENT_DURATION = 10
+STARTUP_TIMEOUT = 10
+
+
+def free_port():
+  """
+  Get a TCP port on the loopback interface that is currently unused.
+  """
+  with socket.socket() as sock:
+    sock.bind((HOST, 0))
+    return sock.getsockname()[1]
+
+
+def start_workers(n_workers, slots):
+  """
+  Start local worker processes and wait until they accept connections.
+
+  n_workers -- the number of worker processes
+  slots -- the number of work items every worker renders in parallel
+
+  returns a list of (process, address) tuples.
+  """
+  workers = []
+  for _ in range(n_workers):
+    address = (HOST, free_port())
+    process = multiprocessing.Process(target=distributed.serve,
+        args=(address, slots), daemon=True)
+    process.start()
+    workers.append((process, address))
+  deadline = time.monotonic() + STARTUP_TIMEOUT
+  for _, address in workers:
+    while True:
+      try:
+        socket.create_connection(address, timeout=1).close()
+        break
+      except OSError:
+        if time.monotonic() > deadline:
+          raise
+        time.sleep(.1)
+  return workers
+
+
+def split(file, directory):
+  """
+  Split the file into keyframe aligned segments like LectureCut does.
+
+  file -- the video to split
+  directory -- the directory the segments are written to
+
+  returns the sorted list of segment paths.
+  """
+  (
+    ffmpeg
+    .input(file)
+    .output(os.path.join(directory, "out%05d.ts"),
+        f="segment",
+        segment_time=SEGMENT_DURATION,
+        c="copy",
+        reset_timestamps=1)
+    .global_args("-loglevel", "error")
+    .global_args("-hide_banner")
+    .global_args("-nostdin")
+    .run()
+  )
+  return sorted(os.path.join(directory, x) for x in os.listdir(directory))
+
+
+def plan(segments, quality):
+  """
+  Build one work item per segment. The first piece starts at the start of
+  the segment and is remuxed, the second one is encoded.
+
+  segments -- the paths of the segments
+  quality -- the quality passed to the workers
+  """
+  half = SEGMENT_DURATION / 2
+  return [{
+    "index": i,
+    "path": path,
+    "trims": [[0, 0, half / 2], [1, half, SEGMENT_DURATION]],
+    "quality": quality,
+  } for i, path in enumerate(segments)]
+
+
+def benchmark(file, n_workers, slots, quality, kill):
+  """
+  Distribute the pieces of a file to local worker processes.
+
+  file -- the video to cut
+  n_workers -- the number of worker processes
+  slots -- the number of work items every worker renders in parallel
+  quality -- the quality passed to the workers
+  kill -- terminate the first worker after the first result
+
+  returns (number of items, rendered items, leftover items, time).
+  """
+  workers = start_workers(n_workers, slots)
+  try:
+    with tempfile.TemporaryDirectory() as tmp:
+      items = plan(split(file, tmp), quality)
+      rendered = []
+
+      def _on_result(item, pieces):
+        if not all(pieces):
+          raise ValueError("empty piece")
+        rendered.append(item["index"])
+        if kill and workers[0][0].is_alive():
+          workers[0][0].terminate()
+
+      start = time.perf_counter()
+      leftovers = distributed.distribute([x[1] for x in workers], items,
+          _on_result)
+      end = time.perf_counter()
+  finally:
+    for process, _ in workers:
+      process.terminate()
+      process.join()
+  return len(items), len(set(rendered)), len(leftovers), end - start
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Run the distributed transcoding against local worker"+\
+          " processes and check that every piece is rendered.")
+  parser.add_argument(
+      "files",
+      help="The video files to cut",
+      nargs="+")
+  parser.add_argument(
+      "-n", "--workers",
+      help="The number of worker processes. Default: 3",
+      type=int,
+      default=3)
+  parser.add_argument(
+      "--slots",
+      help="The number of work items per worker. Default: 2",
+      type=int,
+      default=2)
+  parser.add_argument(
+      "-q", "--quality",
+      help="The quality passed to the workers. Default: 20",
+      type=int,
+      default=20)
+  parser.add_argument(
+      "--kill",
+      help="Terminate one worker after the first result to exercise the"+\
+          " retries.",
+      action="store_true")
+  args = parser.parse_args()
+
+  table = Table(title="Distributed Benchmark")
+  table.add_column("File", justify="left", style="yellow")
+  table.add_column("Items", justify="right", style="cyan")
+  table.add_column("Rendered", justify="right", style="cyan")
+  table.add_column("Leftovers", justify="right", style="magenta")
+  table.add_column("Time", justify="right", style="cyan")
+
+  complete = True
+  for file in args.files:
+    n_items, rendered, leftovers, total = benchmark(file, args.workers,
+        args.slots, args.quality, args.kill)
+    complete = complete and rendered == n_items and not leftovers
+    table.add_row(
+      file,
+      str(n_items),
+      str(rendered),
+      str(leftovers),
+      f"{total:.2f} s",
+    )
+
+  rich.print()
+  rich.print(Align(table, align="center"))
+  rich.print()
+  if not complete:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,246 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+
+import helper
+from helper import render_piece
+
+# Wire format: every message is a 4 byte big endian header length, a JSON
+# header and the binary payloads whose sizes are listed in the header.
+_LENGTH = struct.Struct(">I")
+
+MAX_ATTEMPTS = 3
+CONNECT_TIMEOUT = 10
+WORK_TIMEOUT = 600
+POLL_INTERVAL = 0.5
+
+
+def parse_address(address):
+  """
+  Parse a HOST:PORT string.
+
+  address -- the address to parse
+  """
+  host, port = address.rsplit(":", 1)
+  return host, int(port)
+
+
+def _recv_exactly(sock, size):
+  """
+  Receive exactly size bytes from the socket.
+
+  sock -- the socket to read from
+  size -- the number of bytes to read
+  """
+  data = bytearray()
+  while len(data) < size:
+    chunk = sock.recv(min(size - len(data), 1 << 20))
+    if not chunk:
+      raise ConnectionError("Connection closed by peer")
+    data += chunk
+  return bytes(data)
+
+
+def send_message(sock, header, payloads=()):
+  """
+  Send a message.
+
+  sock -- the socket to write to
+  header -- a JSON serializable dictionary
+  payloads -- a list of bytes objects sent after the header
+  """
+  header = dict(header, sizes=[len(x) for x in payloads])
+  data = json.dumps(header).encode()
+  sock.sendall(_LENGTH.pack(len(data)) + data)
+  for payload in payloads:
+    sock.sendall(payload)
+
+
+def recv_message(sock):
+  """
+  Receive a message.
+
+  sock -- the socket to read from
+
+  returns (header, payloads).
+  """
+  size, = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+  header = json.loads(_recv_exactly(sock, size))
+  payloads = [_recv_exactly(sock, x) for x in header.pop("sizes")]
+  return header, payloads
+
+
+def process_work_item(header, payloads):
+  """
+  Render the pieces of a single segment.
+
+  header -- the work item, holding the keep ranges, the quality and
+            whether to remux in process
+  payloads -- a list containing the segment data
+
+  returns the data of the rendered pieces in the order of the keep ranges.
+  """
+  with tempfile.TemporaryDirectory() as tmp:
+    segment = os.path.join(tmp, "segment.ts")
+    with open(segment, "wb") as f:
+      f.write(payloads[0])
+    pieces = []
+    for j, start, end in header["trims"]:
+      piece = os.path.join(tmp, f"piece{j:03d}.ts")
+      render_piece(segment, piece, (start, end), header["quality"],
+          header.get("in_process") and helper.import_av() is not None)
+      with open(piece, "rb") as f:
+        pieces.append(f.read())
+  return pieces
+
+
+class _WorkerHandler(socketserver.BaseRequestHandler):
+  """Serves work items of a single coordinator connection."""
+
+  def handle(self):
+    send_message(self.request, {"slots": self.server.slots})
+    while True:
+      try:
+        header, payloads = recv_message(self.request)
+      except (ConnectionError, OSError):
+        return
+      try:
+        pieces = process_work_item(header, payloads)
+      except Exception as e:
+        send_message(self.request, {"status": "error", "message": str(e)})
+        continue
+      send_message(self.request, {"status": "ok"}, pieces)
+
+
+class _WorkerServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+def serve(address, slots):
+  """
+  Run a worker that renders pieces for coordinators until interrupted.
+
+  address -- the (host, port) to listen on
+  slots -- the number of work items a coordinator may send in parallel
+  """
+  with _WorkerServer(address, _WorkerHandler) as server:
+    server.slots = slots
+    server.serve_forever()
+
+
+def _connect(address):
+  """
+  Connect to a worker.
+
+  address -- the (host, port) of the worker
+
+  returns (socket, number of slots of the worker).
+  """
+  sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+  sock.settimeout(WORK_TIMEOUT)
+  header, _ = recv_message(sock)
+  return sock, header["slots"]
+
+
+def distribute(addresses, items, on_result):
+  """
+  Render work items on the given workers.
+  Work items that fail are retried, on any worker, up to MAX_ATTEMPTS
+  times. Work items that can not be rendered on a worker are returned so
+  that they can be rendered locally.
+
+  addresses -- a list of (host, port) tuples of the workers
+  items -- a list of work items, each holding the segment "path", the
+           "trims" as [piece number, start, end] and the "quality"
+  on_result -- called with (work item, piece data) for every finished item
+
+  returns the list of work items that were not rendered.
+  """
+  if not items:
+    return []
+  work = queue.Queue()
+  for item in items:
+    work.put(item)
+  failed = []
+  remaining = [len(items)]
+  lock = threading.Lock()
+  done = threading.Event()
+
+  def _finish():
+    with lock:
+      remaining[0] -= 1
+      if remaining[0] == 0:
+        done.set()
+
+  def _retry(item):
+    item["attempts"] = item.get("attempts", 0) + 1
+    if item["attempts"] < MAX_ATTEMPTS:
+      work.put(item)
+    else:
+      failed.append(item)
+      _finish()
+
+  def _slot(sock):
+    with sock:
+      while not done.is_set():
+        try:
+          item = work.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+          continue
+        try:
+          with open(item["path"], "rb") as f:
+            data = f.read()
+          send_message(sock, {
+            "trims": item["trims"],
+            "quality": item["quality"],
+            "in_process": item.get("in_process", False),
+          }, [data])
+          header, pieces = recv_message(sock)
+        except (ConnectionError, OSError, ValueError, KeyError):
+          # the worker is gone or out of sync, let the other slots take over
+          _retry(item)
+          return
+        try:
+          ok = header["status"] == "ok"
+          if ok:
+            on_result(item, pieces)
+        except Exception:
+          ok = False
+        if ok:
+          _finish()
+        else:
+          _retry(item)
+
+  sockets = []
+  for address in addresses:
+    try:
+      sock, slots = _connect(address)
+    except (ConnectionError, OSError, ValueError, KeyError):
+      continue
+    sockets.append(sock)
+    for _ in range(slots - 1):
+      try:
+        sockets.append(_connect(address)[0])
+      except (ConnectionError, OSError, ValueError, KeyError):
+        break
+
+  threads = [threading.Thread(target=_slot, args=(x,)) for x in sockets]
+  for thread in threads:
+    thread.start()
+  while not done.wait(POLL_INTERVAL):
+    if not any(x.is_alive() for x in threads):
+      break
+  done.set()
+  for thread in threads:
+    thread.join()
+
+  leftovers = failed
+  while not work.empty():
+    leftovers.append(work.get())
+  return leftovers
@@ -1,10 +1,62 @@
 import os
+import sys
 import time
 from pathlib import Path
 from queue import Queue
 from threading import Thread
 import cv2
+import ffmpeg
 
+PCM_CHUNK_SIZE = 1 << 16
+MPEGTS_PACKET_SIZE = 188
+# m2ts (AVCHD, Blu-ray) prefixes every ts packet with a 4 byte timecode
+M2TS_PACKET_SIZE = 192
+# enough for two frames of raw mp3 or aac, adts frames are up to 8191 bytes
+AUDIO_SYNC_PROBE_SIZE = 1 << 14
+
+# (offset, signature) of the container formats ffmpeg is used for
+MEDIA_SIGNATURES = [
+  (4, b"ftyp"), # mp4, mov, m4a, 3gp
+  (4, b"moov"), # old QuickTime
+  (4, b"mdat"),
+  (4, b"wide"),
+  (4, b"free"), # QuickTime files starting with padding atoms
+  (4, b"skip"),
+  (4, b"pnot"), # QuickTime preview
+  (0, b"\x1a\x45\xdf\xa3"), # mkv, webm
+  (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11"), # asf, wmv, wma
+  (0, b"\x00\x00\x01\xba"), # mpeg program stream
+  (0, b"\x00\x00\x01\xb3"), # mpeg video elementary stream
+  (0, b"FLV"),
+  (0, b"OggS"),
+  (0, b"fLaC"),
+  (0, b"ID3"), # mp3 with tags
+  (0, b"caff"), # core audio
+  (8, b"AVI "),
+  (8, b"WAVE"),
+  (8, b"AIFF"),
+  (8, b"AIFC"), # compressed aiff
+]
+
+# bitrates in kbps of mpeg audio, indexed by (mpeg 1, layer)
+MPEG_AUDIO_BITRATES = {
+  (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+      416, 448),
+  (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+      384),
+  (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+      320),
+  (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+      256),
+  (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+  (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# sample rates of mpeg audio, indexed by the version bits
+MPEG_AUDIO_SAMPLE_RATES = {
+  0b00: (11025, 12000, 8000), # mpeg 2.5
+  0b10: (22050, 24000, 16000), # mpeg 2
+  0b11: (44100, 48000, 32000), # mpeg 1
+}
 
 def get_video_length(videoPath, progress=None, pbar=None):
   """
@@ -18,9 +70,200 @@ def get_video_length(videoPath, progress=None, pbar=None):
   fps = video.get(cv2.CAP_PROP_FPS)
   frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
   if pbar: progress.update(pbar, advance=1)
+  if not fps or frame_count <= 0:
+    # frame counts are meaningless for audio only files
+    return float(ffmpeg.probe(videoPath)["format"]["duration"])
   return frame_count / fps
 
 
+def is_audio_only(path):
+  """
+  Check whether the given file has audio but no video streams.
+  Cover art embedded in audio files does not count as video.
+
+  path -- the path to the file
+  """
+  streams = ffmpeg.probe(path)["streams"]
+  video = [x for x in streams if x["codec_type"] == "video"
+      and not x.get("disposition", {}).get("attached_pic")]
+  audio = [x for x in streams if x["codec_type"] == "audio"]
+  return len(audio) > 0 and len(video) == 0
+
+
+def is_media_file(path):
+  """
+  Check whether the given file looks like an audio or video file.
+  Only the first few kilobytes of the file are read.
+
+  path -- the path to the file
+  """
+  try:
+    with open(path, "rb") as f:
+      header = f.read(AUDIO_SYNC_PROBE_SIZE)
+  except OSError:
+    return False
+  for offset, signature in MEDIA_SIGNATURES:
+    if header[offset:offset + len(signature)] == signature:
+      return True
+  # mpeg transport stream, sync byte at the start of every packet
+  if len(header) > MPEGTS_PACKET_SIZE and \
+      header[0] == header[MPEGTS_PACKET_SIZE] == 0x47:
+    return True
+  if len(header) > M2TS_PACKET_SIZE + 4 and \
+      header[4] == header[M2TS_PACKET_SIZE + 4] == 0x47:
+    return True
+  # raw mp3 or aac (adts), a valid frame header followed by the next one
+  size = _audio_frame_size(header)
+  return size is not None and _audio_frame_size(header[size:]) is not None
+
+
+def _audio_frame_size(header):
+  """
+  Get the size of the raw mpeg audio or adts frame the data starts with.
+
+  header -- the data to check
+
+  returns the size in bytes or None if there is no valid frame header.
+  """
+  if len(header) < 7 or header[0] != 0xff:
+    return None
+  version = header[1] >> 3 & 0b11
+  layer = 4 - (header[1] >> 1 & 0b11)
+  if header[1] & 0xf6 == 0xf0:
+    # adts, the frame size is stored in the header
+    if header[2] >> 2 & 0xf > 12:
+      return None
+    size = (header[3] & 0b11) << 11 | header[4] << 3 | header[5] >> 5
+    return size if size >= 7 else None
+  if header[1] & 0xe0 != 0xe0 or version == 0b01 or layer == 4:
+    return None
+  bitrate_index = header[2] >> 4
+  rate_index = header[2] >> 2 & 0b11
+  if bitrate_index in (0, 15) or rate_index == 3:
+    return None
+  mpeg1 = version == 0b11
+  bitrate = MPEG_AUDIO_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+  rate = MPEG_AUDIO_SAMPLE_RATES[version][rate_index]
+  padding = header[2] >> 1 & 1
+  if layer == 1:
+    return (12 * bitrate // rate + padding) * 4
+  if layer == 3 and not mpeg1:
+    return 72 * bitrate // rate + padding
+  return 144 * bitrate // rate + padding
+
+
+def import_av():
+  """
+  Import PyAV on first use. Loading it takes a while and it is only
+  needed to remux in process.
+
+  returns the module or None if PyAV is not installed.
+  """
+  try:
+    import av
+  except ImportError:
+    return None
+  return av
+
+
+def _add_stream_from_template(container, template):
+  """
+  Add an output stream with the parameters of the given input stream.
+
+  container -- the PyAV output container
+  template -- the PyAV input stream
+  """
+  # PyAV 14 replaced add_stream(template=...)
+  if hasattr(container, "add_stream_from_template"):
+    return container.add_stream_from_template(template)
+  return container.add_stream(template=template)
+
+
+def remux_piece(segment, piece, end):
+  """
+  Copy the packets of a segment up to the given time into a new file,
+  without starting a ffmpeg process. Requires PyAV.
+
+  segment -- the path of the segment
+  piece -- the path the piece is written to
+  end -- the end of the piece in segment time
+  """
+  av = import_av()
+  with av.open(segment) as source, \
+      av.open(piece, "w", format="mpegts") as target:
+    streams = {}
+    for stream in source.streams:
+      if stream.type in ("video", "audio"):
+        streams[stream.index] = _add_stream_from_template(target, stream)
+    start = (source.start_time or 0) / av.time_base
+    finished = set()
+    for packet in source.demux([source.streams[x] for x in streams]):
+      # skip the flush packets emitted at the end of the input
+      if packet.dts is None or packet.stream.index in finished:
+        continue
+      # like ffmpeg's -to, a stream ends at its first packet that is
+      # decoded after the end, so no frame loses its references
+      if float(packet.dts * packet.time_base) - start >= end:
+        finished.add(packet.stream.index)
+        if len(finished) == len(streams):
+          break
+        continue
+      packet.stream = streams[packet.stream.index]
+      target.mux(packet)
+
+
+def render_piece(segment, piece, trim, quality, in_process=False):
+  """
+  Cut a piece out of a segment.
+
+  segment -- the path of the segment
+  piece -- the path the piece is written to
+  trim -- the (start, end) range to keep in segment time
+  quality -- the crf used if the piece has to be encoded
+  in_process -- stream copy with PyAV instead of starting ffmpeg
+  """
+  # only transcode when a new keyframe needs to be calculated
+  # otherwise just cut P and B frames
+  # TODO: check if this results in a quality loss
+  #       assuming that a P frame that is kept referenced a B frame
+  #       that was cut, might result in the P frame losing its reference
+  #       and thus (to me) unknown behaviour
+  if (trim[0] == 0 and in_process):
+    remux_piece(segment, piece, round(trim[1], 5))
+  elif (trim[0] == 0):
+    (
+      ffmpeg
+      .input(segment)
+      .output(piece,
+          f="mpegts",
+          to=round(trim[1], 5),
+          codec="copy")
+      .global_args("-loglevel", "error")
+      .global_args("-hide_banner")
+      .global_args("-nostdin")
+      .run()
+    )
+  else:
+    (
+      ffmpeg
+      .input(segment)
+      .output(piece,
+          f="mpegts",
+          ss=round(trim[0], 5),
+          to=round(trim[1], 5),
+          acodec="copy",
+          vcodec="libx264",
+          preset="fast",
+          crf=quality,
+          reset_timestamps=1,
+          force_key_frames=0)
+      .global_args("-loglevel", "error")
+      .global_args("-hide_banner")
+      .global_args("-nostdin")
+      .run()
+    )
+
+
 # TODO: replace with shutil.rmtree
 def delete_directory_recursively(path, retryCounter=10):
   """
@@ -61,24 +304,32 @@ def reader(pipe, queue):
   finally:
     queue.put(None)
 
-def read_progress(progress, pbar, ffmpeg_run):
+def read_progress(progress, pbar, ffmpeg_run, progress_pipe=None):
   """
   Read the output of a ffmpeg run and update the given progress bar.
 
   progress -- The manager that controls the progress bars.
   pbar -- The progress bar to update.
   ffmpeg_run -- The ffmpeg run to read the output from.
+  progress_pipe -- The pipe ffmpeg writes its progress to. Defaults to
+                   stdout. Other lines are printed to stderr.
+
+  raises ffmpeg.Error if ffmpeg fails.
   """
+  if progress_pipe is None:
+    progress_pipe = ffmpeg_run.stdout
+  pipes = [x for x in (ffmpeg_run.stdout, ffmpeg_run.stderr) if x]
   q = Queue()
-  Thread(target=reader, args=(ffmpeg_run.stdout, q)).start()
-  Thread(target=reader, args=(ffmpeg_run.stderr, q)).start()
-  for _ in range(2):
+  for pipe in pipes:
+    Thread(target=reader, args=(pipe, q)).start()
+  stderr = bytearray()
+  for _ in range(len(pipes)):
     for source, line in iter(q.get, None):
-      line = line.decode()
-      if source == ffmpeg_run.stderr:
-        print(line)
+      if source != progress_pipe or b"=" not in line:
+        print(line.decode(), file=sys.stderr)
+        stderr += line
       else:
-        line = line.rstrip()
+        line = line.decode().rstrip()
         parts = line.split("=")
         key = parts[0] if len(parts) > 0 else None
         value = parts[1] if len(parts) > 1 else None # TODO: this might cause float(none):
@@ -87,3 +338,33 @@ def read_progress(progress, pbar, ffmpeg_run):
           progress.update(pbar, advance=int(time * 1000))
         elif key == "progress" and value == "end":
           progress.update(pbar, completet=True)
+  if ffmpeg_run.wait() != 0:
+    raise ffmpeg.Error("ffmpeg", None, bytes(stderr))
+
+
+def read_pcm(progress, pbar, ffmpeg_run, sample_rate):
+  """
+  Read 16 bit mono PCM from the stdout of a ffmpeg run and update the
+  given progress bar with the duration of the audio read so far.
+
+  progress -- The manager that controls the progress bars.
+  pbar -- The progress bar to update (total in milliseconds).
+  ffmpeg_run -- The ffmpeg run to read the PCM data from.
+  sample_rate -- The sample rate of the PCM data.
+
+  returns the PCM data, raises ffmpeg.Error if ffmpeg fails.
+  """
+  q = Queue()
+  Thread(target=reader, args=(ffmpeg_run.stderr, q)).start()
+  audio = bytearray()
+  for chunk in iter(lambda: ffmpeg_run.stdout.read(PCM_CHUNK_SIZE), b""):
+    audio += chunk
+    progress.update(pbar, completed=len(audio) * 1000 // (sample_rate * 2))
+  ffmpeg_run.stdout.close()
+  stderr = bytearray()
+  for _, line in iter(q.get, None):
+    print(line.decode(), file=sys.stderr)
+    stderr += line
+  if ffmpeg_run.wait() != 0:
+    raise ffmpeg.Error("ffmpeg", None, bytes(stderr))
+  return audio
@@ -2,15 +2,19 @@
 
 import argparse
 import atexit
+import bisect
+import hashlib
+import json
 import multiprocessing
 import os
+import shutil
+import sys
 import textwrap
 import time
 import uuid
 from itertools import takewhile
 
 import ffmpeg
-from joblib import Parallel, delayed
 
 import rich
 from rich.console import Group
@@ -25,17 +29,49 @@ from rich.progress import (
     TimeElapsedColumn,
 )
 
+import distributed
+import helper
 import vad
-from helper import delete_directory_recursively, read_progress, get_video_length
-from stats import print_stats
+from pool import WorkerPool, run_in_thread
+from manifest import is_up_to_date, write_manifest
+from piececache import PieceCache, fingerprint
+from helper import (
+    delete_directory_recursively,
+    read_progress,
+    read_pcm,
+    render_piece,
+    is_audio_only,
+    is_media_file,
+    get_video_length,
+)
+from stats import print_stats, print_performance, print_pool_stats
 
 N_CORES = multiprocessing.cpu_count()
-PROCESSES = N_CORES // 4
+# ffmpeg uses multiple threads itself, so one worker per few cores
+CORES_PER_WORKER = 4
 
 # TODO: use pathlib
 CACHE_PREFIX = "./" # needs to end with a slash 
+STDIN_CHUNK_SIZE = 1 << 20
+HLS_SEGMENT_DURATION = 4 # seconds
+KEYFRAME_INTERVAL = 2 # seconds, shared by all renditions
+PREVIEW_HEIGHT = 360
+# samples per audio frame when cutting audio, below a millisecond
+AUDIO_CUT_FRAME_SIZE = 32
+CUT_LIST_SUFFIX = ".cuts.json"
 
 instances = {}
+pool = None
+
+def get_pool():
+  """
+  Get the worker pool shared by all stages and files of the session.
+  The pool is created on first use and sized from the core budget.
+  """
+  global pool
+  if pool is None:
+    pool = WorkerPool(max(2, cores // CORES_PER_WORKER))
+  return pool
 
 def init_cache(instance):
   """
@@ -50,6 +86,48 @@ def init_cache(instance):
   os.mkdir(cache_path)
   os.mkdir(cache_path + "/segments")
   os.mkdir(cache_path + "/cutSegments")
+  os.mkdir(cache_path + "/chunks")
+
+def spool_input(instance):
+  """
+  Write the input from stdin into the cache directory of the instance,
+  so the following stages can read it like a regular file.
+
+  instance -- the instance id
+  """
+  global instances
+  cache_path = CACHE_PREFIX + f"{instance}/"
+  with open(cache_path + "input", "wb") as f:
+    shutil.copyfileobj(sys.stdin.buffer, f, STDIN_CHUNK_SIZE)
+  instances[instance]["file"] = cache_path + "input"
+  instances[instance]["spooled"] = True
+
+def get_fingerprint(instance):
+  """
+  Get the fingerprint of the input of the given instance.
+  Input from stdin is spooled to a new file on every run, so only its
+  content is fingerprinted.
+
+  instance -- the instance id
+  """
+  return fingerprint(instances[instance]["file"],
+      not instances[instance].get("spooled", False))
+
+def get_output_target(output):
+  """
+  Get the ffmpeg output and the additional output arguments for the
+  given output file. "-" writes a streamable container to stdout.
+
+  output -- the output file
+  """
+  if output != "-":
+    return output, {}
+  if pipe_format == "mp4":
+    return "pipe:1", {
+      "f": "mp4",
+      "movflags": "frag_keyframe+empty_moov+default_base_moof",
+    }
+  return "pipe:1", {"f": "mpegts"}
 
 def cleanup(instance):
   """
@@ -60,16 +138,72 @@ def cleanup(instance):
   cache_path = CACHE_PREFIX + f"/{instance}/"
   delete_directory_recursively(cache_path)
 
+def load_cut_list(path, source):
+  """
+  Load a cut list that was saved with save_cut_list.
+
+  path -- the path of the cut list
+  source -- the fingerprint of the input the cut list is applied to
+
+  raises ValueError if the cut list was made for a different input.
+  """
+  with open(path) as f:
+    cut_list = json.load(f)
+  if not isinstance(cut_list, dict) or cut_list.get("source") != source:
+    raise ValueError(f"The cut list {path} was made for a different" +\
+        " input, remove it or pass a different --cuts file")
+  return [tuple(x) for x in cut_list["cuts"]]
+
+def save_cut_list(path, source, cuts):
+  """
+  Save a cut list, so it can be rendered later without analysing the
+  audio again. The fingerprint of the input is stored with it, so the
+  list is not applied to a different or changed input.
+
+  path -- the path of the cut list
+  source -- the fingerprint of the input the cut list was made for
+  cuts -- the list of (start, end) ranges to keep
+  """
+  with open(path, "w") as f:
+    json.dump({"source": source, "cuts": cuts}, f, indent=2)
+
+def hash_cut_list(path):
+  """
+  Get a hash of the contents of a cut list file, or None if there is no
+  such file.
+
+  path -- the path of the cut list or None
+  """
+  if not path or not os.path.isfile(path):
+    return None
+  with open(path, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
 def generate_cut_list(instance):
   """
   Generate a list of segments that should not be cut out of the video.
   The list is stored in the instances dictionary.
+  A cut list file passed with --cuts is loaded if it exists and saved
+  to otherwise. The default cut list file of a preview is always
+  overwritten with a new analysis.
 
   instance -- the instance id
   """
   global instances
   file = instances[instance]["file"]
-  instances[instance]["cuts"] = vad.run(file, aggressiveness, invert)
+  cut_list = instances[instance].get("cut_list")
+  # audio is only present if it was decoded while segmenting
+  audio = instances[instance].pop("audio", None)
+  if cut_list and instances[instance].get("load_cut_list") and \
+      os.path.isfile(cut_list):
+    instances[instance]["cuts"] = load_cut_list(cut_list,
+        get_fingerprint(instance))
+    return
+  instances[instance]["cuts"] = vad.run(file, aggressiveness, invert, audio,
+      detector)
+  if cut_list:
+    save_cut_list(cut_list, get_fingerprint(instance),
+        instances[instance]["cuts"])
 
 def prepare_video(progress, instance):
   """
@@ -112,6 +246,46 @@ def _split_video(progress, instance):
   )
   read_progress(progress, pbar, split)
 
+def _split_video_with_audio(progress, instance):
+  """
+  Split the video into segments based on keyframes and decode the audio
+  for the VAD in the same ffmpeg process. This way the input only has
+  to be read once.
+  The decoded audio is stored in the instances dictionary.
+
+  progress -- the manager for the progress bars
+  instance -- the instance id
+  """
+  global instances
+  cache_path = CACHE_PREFIX + f"/{instance}/"
+  file = instances[instance]["file"]
+
+  total_input_length = get_video_length(file)
+  bar_total = int(total_input_length * 1000)
+
+  pbar = progress.add_task("[magenta]Segmenting", total=bar_total)
+
+  stream = ffmpeg.input(file)
+  segments = stream.output(cache_path + "segments/out%05d.ts",
+      f="segment",
+      c="copy",
+      reset_timestamps=1)
+  audio = stream.audio.output("pipe:",
+      format="s16le",
+      acodec="pcm_s16le",
+      ac=1,
+      ar=vad.SAMPLE_RATE)
+  split = (
+    ffmpeg
+    .merge_outputs(segments, audio)
+    .global_args("-loglevel", "error")
+    .global_args("-hide_banner")
+    .global_args("-nostdin")
+    .run_async(pipe_stdout=True, pipe_stderr=True)
+  )
+  instances[instance]["audio"] = read_pcm(progress, pbar, split,
+      vad.SAMPLE_RATE)
+
 def _analyse_segments(progress, instance):
   """
   Analyse the length of each segment of the video.
@@ -127,10 +301,10 @@ def _analyse_segments(progress, instance):
 
   pbar = progress.add_task("[magenta]Analysing", total=len(segments))
 
-  durations = Parallel(n_jobs=PROCESSES)(
-      delayed(get_video_length)
-      (f"{cache_path}segments/{path}", progress, pbar)
-      for path in segments)
+  durations = get_pool().map(
+      lambda path: get_video_length(f"{cache_path}segments/{path}",
+          progress, pbar),
+      segments)
   # calculate start end map
   total_duration = 0
   for i, duration in enumerate(durations):
@@ -141,6 +315,81 @@ def _analyse_segments(progress, instance):
     total_duration += duration
 
 
+def plan_segment(segment, cuts):
+  """
+  Find the parts of a single segment that need to be kept.
+
+  segment -- the segment start end map
+  cuts -- the list of (start, end) ranges to keep
+
+  returns None if the whole segment is kept, otherwise a list of
+  (start, end) keep ranges in segment time.
+  """
+  # cats are segments that need to be kept
+  # find id of first cut ending after segment start
+  first_cut_id, first_cut = next((x for x in enumerate(cuts)
+      if x[1][1] > segment["start"]), (-1, None))
+
+  # skip segment if it ends before the current cut starts
+  if first_cut == None or first_cut[0] >= segment["end"]:
+    return []
+
+  # if completely enclosed by a cut, copy
+  if first_cut[0] <= segment["start"] and first_cut[1] >= segment["end"]:
+    return None
+
+  # find all cuts that start before segment end
+  cuts_in_segment = list(takewhile(lambda x: x[0] < segment["end"],
+      cuts[first_cut_id+1:]))
+  all_cuts = [first_cut] + cuts_in_segment
+
+  keep = []
+  for cut in all_cuts:
+    start = max(segment["start"], cut[0])
+    end = min(segment["end"], cut[1])
+    keep.append((start, end))
+
+  # filter keep list to remove segments that are too short
+  keep = [x for x in keep if x[1] - x[0] > 0.1]
+
+  # convert keep list from global time to segment time
+  return [(x[0] - segment["start"], x[1] - segment["start"]) for x in keep]
+
+def count_encodes(segments, cuts):
+  """
+  Count the pieces that can not be stream copied, because they do not
+  start at a keyframe.
+
+  segments -- the segment start end maps
+  cuts -- the list of (start, end) ranges to keep
+  """
+  plans = [plan_segment(x, cuts) for x in segments.values()]
+  return sum(1 for keep in plans if keep for trim in keep if trim[0] != 0)
+
+def snap_cuts(segments, cuts, tolerance):
+  """
+  Move the start of every keep range back to the closest earlier segment
+  start if it is at most tolerance seconds away. Segments start with a
+  keyframe, so the pieces starting there can be stream copied.
+  Keep ranges are only ever widened. Ranges that overlap after snapping
+  are merged.
+
+  segments -- the segment start end maps
+  cuts -- the list of (start, end) ranges to keep
+  tolerance -- the maximum distance a start is moved in seconds
+  """
+  starts = sorted(x["start"] for x in segments.values())
+  snapped = []
+  for start, end in cuts:
+    k = bisect.bisect_right(starts, start) - 1
+    if k >= 0 and start - starts[k] <= tolerance:
+      start = starts[k]
+    if snapped and start <= snapped[-1][1]:
+      snapped[-1] = (snapped[-1][0], max(snapped[-1][1], end))
+    else:
+      snapped.append((start, end))
+  return snapped
+
 def transcode(progress, instance):
   """
   Transcode the video.
@@ -154,94 +403,125 @@ def transcode(progress, instance):
   segments = instances[instance]["segments"]
   cuts = instances[instance]["cuts"]
 
+  if snap_tolerance:
+    encodes = count_encodes(segments, cuts)
+    cuts = snap_cuts(segments, cuts, snap_tolerance)
+    instances[instance]["cuts"] = cuts
+    instances[instance]["avoided_encodes"] = \
+        encodes - count_encodes(segments, cuts)
+
+  cache = None
+  if piece_cache:
+    cache = PieceCache(piece_cache, get_fingerprint(instance))
+
   pbar = progress.add_task("[magenta]Transcoding", total=len(segments))
 
+  def _piece_key(i, trim):
+    settings = ["copy"] if trim[0] == 0 else ["libx264", "fast", quality]
+    return cache.key(i, segments[i], trim, settings)
+
+  def _fetch_pieces(i, keep):
+    """
+    Take the pieces of a segment from the piece cache where possible.
+
+    i -- the segment number
+    keep -- the keep ranges of the segment
+
+    returns the number of reused pieces and a list of (piece number,
+    keep range) tuples that still need to be rendered.
+    """
+    if not cache:
+      return 0, list(enumerate(keep))
+    pending = []
+    for j, trim in enumerate(keep):
+      piece = f"{cache_path}cutSegments/out{i:05d}_{j:03d}.ts"
+      if not cache.fetch(_piece_key(i, trim), piece):
+        pending.append((j, trim))
+    return len(keep) - len(pending), pending
+
+  def _render_pieces(i, pending):
+    """
+    Render the pieces of a segment locally.
+
+    i -- the segment number
+    pending -- a list of (piece number, keep range) tuples
+    """
+    for j, trim in pending:
+      piece = f"{cache_path}cutSegments/out{i:05d}_{j:03d}.ts"
+      render_piece(f"{cache_path}segments/out{i:05d}.ts", piece, trim,
+          quality, in_process_remux)
+      if cache:
+        cache.store(_piece_key(i, trim), piece)
+
+  def _keep_whole_segment(i):
+    os.rename(f"{cache_path}segments/out{i:05d}.ts",
+        f"{cache_path}cutSegments/out{i:05d}.ts")
+
   def _process_segment(i):
     """
     Process a single segment.
 
     i -- the segment number
+
+    returns the number of pieces that were taken from the piece cache.
     """
-    # cats are segments that need to be kept
-    segment = segments[i]
+    keep = plan_segment(segments[i], cuts)
+    reused = 0
+    if keep is None:
+      _keep_whole_segment(i)
+    else:
+      reused, pending = _fetch_pieces(i, keep)
+      _render_pieces(i, pending)
+    progress.update(pbar, advance=1)
+    return reused
 
-    # find id of first cut ending after segment start
-    first_cut_id, first_cut = next((x for x in enumerate(cuts)
-        if x[1][1] > segment["start"]), (-1, None))
+  if not workers:
+    reused = get_pool().map(_process_segment, segments)
+    instances[instance]["reused_pieces"] = sum(reused)
+    return
 
-    # skip segment if it ends before the current cut starts
-    if first_cut == None or first_cut[0] >= segment["end"]:
+  # plan locally, render the pieces on the workers
+  reused = 0
+  items = []
+  for i in segments:
+    keep = plan_segment(segments[i], cuts)
+    if keep is None:
+      _keep_whole_segment(i)
       progress.update(pbar, advance=1)
-      return
-
-    # if completely enclosed by a cut, copy
-    if first_cut[0] <= segment["start"] and first_cut[1] >= segment["end"]:
-      os.rename(f"{cache_path}segments/out{i:05d}.ts",
-          f"{cache_path}cutSegments/out{i:05d}.ts")
+      continue
+    n_reused, pending = _fetch_pieces(i, keep)
+    reused += n_reused
+    if not pending:
       progress.update(pbar, advance=1)
-      return
-
-    # find all cuts that start before segment end
-    cuts_in_segment = list(takewhile(lambda x: x[0] < segment["end"],
-        cuts[first_cut_id+1:]))
-    all_cuts = [first_cut] + cuts_in_segment
-
-    keep = []
-    for cut in all_cuts:
-      start = max(segment["start"], cut[0])
-      end = min(segment["end"], cut[1])
-      keep.append((start, end))
-
-    # filter keep list to remove segments that are too short
-    keep = [x for x in keep if x[1] - x[0] > 0.1]
-
-    # convert keep list from global time to segment time
-    keep = [(x[0] - segment["start"], x[1] - segment["start"]) for x in keep]
-
-    for j,trim in enumerate(keep):
-      # only transcode when a new keyframe needs to be calculated
-      # otherwise just cut P and B frames
-      # TODO: check if this results in a quality loss
-      #       assuming that a P frame that is kept referenced a B frame
-      #       that was cut, might result in the P frame losing its reference
-      #       and thus (to me) unknown behaviour
-      if (trim[0] == 0):
-        (
-          ffmpeg
-          .input(f"{cache_path}segments/out{i:05d}.ts")
-          .output(f"{cache_path}cutSegments/out{i:05d}_{j:03d}.ts",
-              f="mpegts",
-              to=round(trim[1], 5),
-              codec="copy")
-          .global_args("-loglevel", "error")
-          .global_args("-hide_banner")
-          .global_args("-nostdin")
-          .run()
-        )
-      else:
-        (
-          ffmpeg
-          .input(f"{cache_path}segments/out{i:05d}.ts")
-          .output(f"{cache_path}cutSegments/out{i:05d}_{j:03d}.ts",
-              f="mpegts",
-              ss=round(trim[0], 5),
-              to=round(trim[1], 5),
-              acodec="copy",
-              vcodec="libx264",
-              preset="fast",
-              crf=quality,
-              reset_timestamps=1,
-              force_key_frames=0)
-          .global_args("-loglevel", "error")
-          .global_args("-hide_banner")
-          .global_args("-nostdin")
-          .run()
-        )
+      continue
+    items.append({
+      "index": i,
+      "path": f"{cache_path}segments/out{i:05d}.ts",
+      "trims": [[j, trim[0], trim[1]] for j, trim in pending],
+      "quality": quality,
+      "in_process": in_process_remux,
+    })
+
+  def _on_result(item, pieces):
+    i = item["index"]
+    for (j, start, end), data in zip(item["trims"], pieces):
+      piece = f"{cache_path}cutSegments/out{i:05d}_{j:03d}.ts"
+      with open(piece, "wb") as f:
+        f.write(data)
+      if cache:
+        cache.store(_piece_key(i, (start, end)), piece)
     progress.update(pbar, advance=1)
-  Parallel(n_jobs=PROCESSES, require="sharedmem")(
-      delayed(_process_segment)
-      (i)
-      for i in segments)
+
+  leftovers = distributed.distribute(workers, items, _on_result)
+
+  def _render_leftover(item):
+    _render_pieces(item["index"],
+        [(j, (start, end)) for j, start, end in item["trims"]])
+    progress.update(pbar, advance=1)
+
+  # render whatever the workers could not handle locally
+  get_pool().map(_render_leftover, leftovers)
+  instances[instance]["reused_pieces"] = reused
 
 
 def concat_segments(progress, instance):
@@ -253,9 +533,19 @@ def concat_segments(progress, instance):
   """
   cache_path = f"{CACHE_PREFIX}{instance}/"
   output = instances[instance]["output"]
+  pieces = sorted(os.listdir(f"{cache_path}cutSegments"))
   with open(f"{cache_path}list.txt", "w") as f:
-    for file in sorted(os.listdir(f"{cache_path}cutSegments")):
+    for file in pieces:
       f.write(f"file 'cutSegments/{file}'\n")
+
+  if renditions:
+    _concat_renditions(progress, instance)
+    return
+
+  if reencode and parallel_reencode and pieces:
+    _concat_chunked(progress, instance, pieces)
+    return
+
   total_cut_length = sum([x[1] - x[0] for x in instances[instance]["cuts"]])
   bar_total = int(total_cut_length * 1000)
   
@@ -272,10 +562,94 @@ def concat_segments(progress, instance):
     outputargs = {
       "c": "copy",
     }
+  target, targetargs = get_output_target(output)
   concat = (
     ffmpeg
     .input(f"{cache_path}list.txt", f="concat", safe=0)
-    .output(output, **outputargs)
+    .output(target, **outputargs, **targetargs)
+  )
+  # stdout carries the video when writing to a pipe
+  _run_with_progress(progress, pbar, concat, target == "pipe:1")
+
+def get_rendition_path(output, height):
+  """
+  Get the path of a single rendition of the output.
+  For HLS this is the playlist of the rendition.
+
+  output -- the output file
+  height -- the height of the rendition
+  """
+  base, ext = os.path.splitext(output)
+  if hls:
+    return f"{base}_hls/{height}p/index.m3u8"
+  return f"{base}_{height}p{ext}"
+
+def _write_master_playlist(instance):
+  """
+  Write the HLS master playlist referencing all renditions.
+
+  instance -- the instance id
+  """
+  output = instances[instance]["output"]
+  duration = sum([x[1] - x[0] for x in instances[instance]["cuts"]])
+  master = f"{os.path.splitext(output)[0]}_hls/master.m3u8"
+  with open(master, "w") as f:
+    f.write("#EXTM3U\n#EXT-X-VERSION:3\n")
+    for height in renditions:
+      playlist = get_rendition_path(output, height)
+      folder = os.path.dirname(playlist)
+      size = sum(os.path.getsize(os.path.join(folder, x))
+          for x in os.listdir(folder))
+      bandwidth = int(size * 8 / max(duration, 1))
+      f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth}\n")
+      f.write(f"{height}p/index.m3u8\n")
+  return master
+
+def _concat_renditions(progress, instance):
+  """
+  Concatenate the segments and encode all renditions from a single
+  decode. The decoded video is split and scaled for every rendition.
+  All renditions use the same keyframe layout.
+
+  progress -- the manager for the progress bars
+  instance -- the instance id
+  """
+  global instances
+  cache_path = f"{CACHE_PREFIX}{instance}/"
+  output = instances[instance]["output"]
+
+  total_cut_length = sum([x[1] - x[0] for x in instances[instance]["cuts"]])
+  bar_total = int(total_cut_length * 1000)
+  pbar = progress.add_task("[magenta]Rendering", total=bar_total)
+
+  source = ffmpeg.input(f"{cache_path}list.txt", f="concat", safe=0)
+  videos = source.video.filter_multi_output("split", len(renditions))
+  outputs = []
+  for k, height in enumerate(renditions):
+    path = get_rendition_path(output, height)
+    outputargs = {
+      "vcodec": "libx264",
+      "preset": "fast",
+      "crf": quality,
+      "acodec": "aac",
+      "force_key_frames": f"expr:gte(t,n_forced*{KEYFRAME_INTERVAL})",
+      "sc_threshold": 0,
+    }
+    if hls:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      outputargs.update({
+        "f": "hls",
+        "hls_time": HLS_SEGMENT_DURATION,
+        "hls_playlist_type": "vod",
+        "hls_segment_filename": os.path.join(os.path.dirname(path),
+            "segment%05d.ts"),
+      })
+    video = videos[k].filter("scale", -2, height)
+    outputs.append(ffmpeg.output(video, source.audio, path, **outputargs))
+
+  concat = (
+    ffmpeg
+    .merge_outputs(*outputs)
     .global_args("-progress", "pipe:1")
     .global_args("-loglevel", "error")
     .global_args("-hide_banner")
@@ -284,6 +658,214 @@ def concat_segments(progress, instance):
   )
   read_progress(progress, pbar, concat)
 
+  if hls:
+    instances[instance]["outputs"] = [_write_master_playlist(instance)]
+  else:
+    instances[instance]["outputs"] = [get_rendition_path(output, x)
+        for x in renditions]
+
+def _run_with_progress(progress, pbar, stream, to_stdout):
+  """
+  Run a ffmpeg output stream and update the progress bar while it runs.
+
+  progress -- the manager for the progress bars
+  pbar -- the progress bar (total in milliseconds)
+  stream -- the ffmpeg-python output stream
+  to_stdout -- whether the output is written to stdout
+  """
+  run = (
+    stream
+    .global_args("-progress", "pipe:2" if to_stdout else "pipe:1")
+    .global_args("-loglevel", "error")
+    .global_args("-hide_banner")
+    .global_args("-nostdin")
+    .run_async(pipe_stdout=not to_stdout, pipe_stderr=True)
+  )
+  read_progress(progress, pbar, run, run.stderr if to_stdout else run.stdout)
+
+def get_selection(cuts):
+  """
+  Get a select expression that is true inside the given keep ranges.
+
+  cuts -- the list of (start, end) ranges to keep
+  """
+  return "+".join(f"between(t,{x[0]},{x[1]})" for x in cuts)
+
+def render_preview(progress, instance):
+  """
+  Render a low resolution proxy of the cut result straight from the
+  input in a single ultrafast pass, optionally with the original
+  position burned in.
+
+  progress -- the manager for the progress bars
+  instance -- the instance id
+  """
+  cache_path = f"{CACHE_PREFIX}{instance}/"
+  file = instances[instance]["file"]
+  output = instances[instance]["output"]
+  cuts = instances[instance]["cuts"]
+
+  total_cut_length = sum([x[1] - x[0] for x in cuts])
+  bar_total = int(total_cut_length * 1000)
+  pbar = progress.add_task("[magenta]Previewing", total=bar_total)
+
+  selection = get_selection(cuts)
+  video_filter = f"scale=-2:{PREVIEW_HEIGHT}"
+  if timecode:
+    # drawn before selecting, so it shows the position in the input
+    video_filter += ",drawtext=text='%{pts\\:hms}':x=10:y=10" +\
+        ":fontsize=24:fontcolor=white:box=1:boxcolor=black@0.5"
+  video_filter += f",select='{selection}',setpts=N/FRAME_RATE/TB"
+  with open(f"{cache_path}preview_video.txt", "w") as f:
+    f.write(video_filter)
+  with open(f"{cache_path}preview_audio.txt", "w") as f:
+    f.write(f"aselect='{selection}',asetpts=N/SR/TB")
+
+  target, targetargs = get_output_target(output)
+  preview = (
+    ffmpeg
+    .input(file)
+    .output(target,
+        vcodec="libx264",
+        preset="ultrafast",
+        crf=35,
+        acodec="aac",
+        audio_bitrate="64k",
+        **{
+          "filter_script:v": f"{cache_path}preview_video.txt",
+          "filter_script:a": f"{cache_path}preview_audio.txt",
+        },
+        **targetargs)
+  )
+  _run_with_progress(progress, pbar, preview, target == "pipe:1")
+
+def cut_audio(progress, instance):
+  """
+  Cut an audio only input in a single ffmpeg pass.
+  No segmenting is needed, as every audio frame can be cut.
+
+  progress -- the manager for the progress bars
+  instance -- the instance id
+  """
+  cache_path = f"{CACHE_PREFIX}{instance}/"
+  file = instances[instance]["file"]
+  output = instances[instance]["output"]
+  cuts = instances[instance]["cuts"]
+
+  total_cut_length = sum([x[1] - x[0] for x in cuts])
+  bar_total = int(total_cut_length * 1000)
+  pbar = progress.add_task("[magenta]Rendering", total=bar_total)
+
+  # the filter is passed as a script, as long lectures result in
+  # expressions that are too long for the command line. aselect keeps or
+  # drops whole frames, so the decoded frames of up to 1152 samples are
+  # split into tiny ones first to make the cuts accurate.
+  with open(f"{cache_path}filter.txt", "w") as f:
+    f.write(f"asetnsamples=n={AUDIO_CUT_FRAME_SIZE}:p=0," +\
+        f"aselect='{get_selection(cuts)}',asetpts=N/SR/TB")
+
+  target, targetargs = get_output_target(output)
+  cut = (
+    ffmpeg
+    .input(file)
+    .output(target,
+        vn=None,
+        **{"filter_script:a": f"{cache_path}filter.txt"},
+        **targetargs)
+  )
+  _run_with_progress(progress, pbar, cut, target == "pipe:1")
+
+def _concat_chunked(progress, instance, pieces):
+  """
+  Reencode the pieces in parallel chunks and concatenate the chunks.
+  Every chunk is encoded with the same settings and closed GOPs, so the
+  chunks can be concatenated without reencoding. The audio is encoded
+  in one go to avoid gaps at the chunk borders. As the video chunks end
+  with their last frame, every chunk is given the summed duration of its
+  pieces, so the video stays in sync with the audio.
+
+  progress -- the manager for the progress bars
+  instance -- the instance id
+  pieces -- the sorted file names of the pieces in cutSegments
+  """
+  cache_path = f"{CACHE_PREFIX}{instance}/"
+  output = instances[instance]["output"]
+
+  n_chunks = min(len(pieces), get_pool().workers * 2)
+  chunk_size = -(-len(pieces) // n_chunks)
+  chunks = [pieces[x:x + chunk_size]
+      for x in range(0, len(pieces), chunk_size)]
+
+  # one step per chunk, the audio and the final concatenation
+  pbar = progress.add_task("[magenta]Rendering", total=len(chunks) + 2)
+
+  def _encode_chunk(k):
+    """
+    Encode the video of a chunk.
+
+    k -- the chunk number
+
+    returns the duration of the chunk as used by the concat demuxer.
+    """
+    with open(f"{cache_path}chunk{k:03d}.txt", "w") as f:
+      for file in chunks[k]:
+        f.write(f"file 'cutSegments/{file}'\n")
+    # the concat demuxer places the audio of list.txt by these durations,
+    # read them in process instead of starting a ffprobe per piece
+    duration = sum(get_video_length(f"{cache_path}cutSegments/{x}")
+        for x in chunks[k])
+    (
+      ffmpeg
+      .input(f"{cache_path}chunk{k:03d}.txt", f="concat", safe=0)
+      .output(f"{cache_path}chunks/out{k:03d}.ts",
+          f="mpegts",
+          an=None,
+          vcodec="libx264",
+          preset="fast",
+          crf=quality,
+          flags="+cgop")
+      .global_args("-loglevel", "error")
+      .global_args("-hide_banner")
+      .global_args("-nostdin")
+      .run()
+    )
+    progress.update(pbar, advance=1)
+    return duration
+
+  def _encode_audio():
+    (
+      ffmpeg
+      .input(f"{cache_path}list.txt", f="concat", safe=0)
+      .output(f"{cache_path}audio.m4a",
+          vn=None,
+          acodec="aac")
+      .global_args("-loglevel", "error")
+      .global_args("-hide_banner")
+      .global_args("-nostdin")
+      .run()
+    )
+    progress.update(pbar, advance=1)
+
+  _, *durations = get_pool().wait([get_pool().submit(_encode_audio)] +
+      [get_pool().submit(_encode_chunk, k) for k in range(len(chunks))])
+
+  with open(f"{cache_path}chunks.txt", "w") as f:
+    for k, duration in enumerate(durations):
+      f.write(f"file 'chunks/out{k:03d}.ts'\n")
+      f.write(f"duration {duration:.6f}\n")
+  video = ffmpeg.input(f"{cache_path}chunks.txt", f="concat", safe=0)
+  audio = ffmpeg.input(f"{cache_path}audio.m4a")
+  target, targetargs = get_output_target(output)
+  (
+    ffmpeg
+    .output(video.video, audio.audio, target, c="copy", **targetargs)
+    .global_args("-loglevel", "error")
+    .global_args("-hide_banner")
+    .global_args("-nostdin")
+    .run()
+  )
+  progress.update(pbar, advance=1)
+
 def generate_progress_instance():
   return Progress(
     TextColumn("{task.description}", justify="right"),
@@ -302,6 +884,8 @@ def run(progress, config):
 
   progress -- the manager for the progress bars
   config -- the config for the instance
+
+  returns the list of produced output files.
   """
   global instances
 
@@ -317,24 +901,73 @@ def run(progress, config):
     instances[instance][key] = config[key]
 
   init_cache(instance)
-  Parallel(n_jobs=2, require="sharedmem")([
-      delayed(generate_cut_list)(instance),
-      delayed(prepare_video)(progress, instance)])
+  if instances[instance]["file"] == "-":
+    spool_input(instance)
+  if is_audio_only(instances[instance]["file"]):
+    generate_cut_list(instance)
+    cut_audio(progress, instance)
+    cleanup(instance)
+    return [instances[instance]["output"]]
+  if preview:
+    generate_cut_list(instance)
+    render_preview(progress, instance)
+    cleanup(instance)
+    cut_list = instances[instance].get("cut_list")
+    if cut_list:
+      rich.print(f"Cut list: [yellow]{cut_list}[/yellow]\n" +\
+          f"Render the full video with [cyan]--cuts \"{cut_list}\"\n")
+    return [instances[instance]["output"]]
+  # the speech detection runs in its own thread and the video stages on
+  # this one, so neither holds a worker of the pool while waiting
+  if single_pass:
+    _split_video_with_audio(progress, instance)
+    analysis = run_in_thread(generate_cut_list, instance)
+    _analyse_segments(progress, instance)
+  else:
+    analysis = run_in_thread(generate_cut_list, instance)
+    prepare_video(progress, instance)
+  analysis.result()
   transcode(progress, instance)
   concat_segments(progress, instance)
   cleanup(instance)
 
+  if snap_tolerance:
+    rich.print("Avoided [cyan]" +\
+        f"{instances[instance]['avoided_encodes']}[/cyan] encodes" +\
+        " by snapping cuts to keyframes\n")
+  if piece_cache:
+    rich.print("Reused [cyan]" +\
+        f"{instances[instance]['reused_pieces']}[/cyan] cached pieces\n")
+
+  return instances[instance].get("outputs", [instances[instance]["output"]])
+
 
 invert = False
 quality = 20
 aggressiveness = 3
 reencode = False
+single_pass = False
+piece_cache = None
+workers = []
+detector = "webrtc"
+snap_tolerance = 0
+parallel_reencode = False
+pipe_format = "mpegts"
+in_process_remux = False
+renditions = []
+hls = False
+cores = N_CORES
+preview = False
+timecode = False
 
 def parse_args():
   """
   Parse the command line arguments.
   """
-  global invert, quality, aggressiveness, reencode
+  global invert, quality, aggressiveness, reencode, single_pass
+  global piece_cache, workers, detector, snap_tolerance
+  global parallel_reencode, pipe_format, in_process_remux
+  global renditions, hls, cores, preview, timecode
   parser = argparse.ArgumentParser(description=textwrap.dedent("""
     LectureCut is a tool to remove silence from videos.
 
@@ -347,12 +980,12 @@ def parse_args():
 
   parser.add_argument(
       "-i", "--input",
-      help="The video file to process",
-      required=True)
+      help="The video file to process. Use - to read from stdin",
+      required=False)
   parser.add_argument(
       "-o", "--output",
       help="The output file. If not specified,"+\
-          " the input file will be overwritten",
+          " the input file will be overwritten. Use - to write to stdout",
       required=False)
   parser.add_argument(
       "-q", "--quality",
@@ -372,15 +1005,130 @@ def parse_args():
       help="Reencode the video with a given video codec.",
       required=False,
       type=str)
+  parser.add_argument(
+      "--parallel-reencode",
+      help="Reencode the output in parallel chunks with closed GOPs and"+\
+          " concatenate them without reencoding. Only used with"+\
+          " --reencode.",
+      required=False,
+      action="store_true")
+  parser.add_argument(
+      "--preview",
+      help="Render a fast low resolution preview of the cut result"+\
+          " instead of the full video. The cut list is saved, so the full"+\
+          " render can reuse it with --cuts.",
+      required=False,
+      action="store_true")
+  parser.add_argument(
+      "--timecode",
+      help="Burn the position in the input into the preview.",
+      required=False,
+      action="store_true")
+  parser.add_argument(
+      "--cuts",
+      help="Load the cut list from this file instead of analysing the"+\
+          " audio, or save it there if the file does not exist yet."+\
+          " For directories, this is a directory of cut lists."+\
+          " With --preview, defaults to the input's directory, where the"+\
+          " cut list is overwritten with a new analysis on every run.",
+      required=False,
+      type=str)
+  parser.add_argument(
+      "--renditions",
+      help="Comma separated list of heights, e.g. 1080,720,480."+\
+          " Every rendition is encoded from a single decode of the kept"+\
+          " parts and written next to the output with the height appended.",
+      required=False,
+      type=str)
+  parser.add_argument(
+      "--hls",
+      help="Write the renditions as HLS segment sets with a master"+\
+          " playlist. Requires --renditions.",
+      required=False,
+      action="store_true")
+  parser.add_argument(
+      "--pipe-format",
+      help="The streamable container used when writing to stdout."+\
+          " Default: mpegts",
+      required=False,
+      choices=["mpegts", "mp4"],
+      default="mpegts")
+  parser.add_argument(
+      "--force",
+      help="Process all files of a directory, including the ones whose"+\
+          " outputs are up to date.",
+      required=False,
+      action="store_true")
+  parser.add_argument(
+      "--cores",
+      help="The number of cores LectureCut may use. All stages and files"+\
+          f" share one worker pool sized from it. Default: {N_CORES}",
+      required=False,
+      type=int)
   parser.add_argument(
       "--invert",
       help="Invert the selection."+\
           " This will cut out all segments that are not silence.",
       required=False,
       action="store_true")
+  parser.add_argument(
+      "--detector",
+      help="The speech detector backend. \"webrtc\" uses WebRTC's VAD,"+\
+          " \"energy\" compares the frame energy to an adaptive noise"+\
+          " floor and is much faster. Default: webrtc",
+      required=False,
+      choices=list(vad.DETECTORS),
+      default="webrtc")
+  parser.add_argument(
+      "--snap-tolerance",
+      help="Move the start of kept parts up to the given number of seconds"+\
+          " back to the previous keyframe. Parts are only widened, never"+\
+          " shortened. Parts starting at a keyframe are not reencoded.",
+      required=False,
+      type=float,
+      default=0)
+  parser.add_argument(
+      "--single-pass",
+      help="Read the input only once by segmenting the video and decoding"+\
+          " the audio for the VAD in the same ffmpeg process."+\
+          " Useful for inputs on network storage.",
+      required=False,
+      action="store_true")
+  parser.add_argument(
+      "--in-process-remux",
+      help="Stream copy pieces with PyAV inside LectureCut instead of"+\
+          " starting a ffmpeg process per piece. Requires PyAV.",
+      required=False,
+      action="store_true")
+  parser.add_argument(
+      "--piece-cache",
+      help="Directory to keep rendered pieces in between runs."+\
+          " Re-rendering with a changed cut list only renders the pieces"+\
+          " whose boundaries changed.",
+      required=False,
+      type=str)
+  parser.add_argument(
+      "--workers",
+      help="Comma separated HOST:PORT list of workers to distribute the"+\
+          " transcoding to. Pieces that fail on all workers are"+\
+          " transcoded locally.",
+      required=False,
+      type=str)
+  parser.add_argument(
+      "--worker",
+      help="Run as a worker that transcodes pieces for a coordinator,"+\
+          " listening on the given HOST:PORT. Coordinators are not"+\
+          " authenticated, so only listen on trusted networks.",
+      required=False,
+      type=str)
 
   args = parser.parse_args()
 
+  if not args.input and not args.worker:
+    parser.error("the following arguments are required: -i/--input")
+  if args.input and args.output == "-" and os.path.isdir(args.input):
+    parser.error("a directory of inputs can not be written to stdout")
+
   if args.invert:
     invert = True
   if args.quality:
@@ -389,6 +1137,45 @@ def parse_args():
     aggressiveness = args.aggressiveness
   if args.reencode:
     reencode = args.reencode
+  if args.single_pass:
+    single_pass = True
+  if args.parallel_reencode:
+    parallel_reencode = True
+  if args.pipe_format:
+    pipe_format = args.pipe_format
+  if args.cores:
+    cores = args.cores
+  if args.preview:
+    preview = True
+  if args.timecode:
+    if not args.preview:
+      parser.error("--timecode requires --preview")
+    timecode = True
+  if args.renditions:
+    if args.output == "-" or (args.input == "-" and not args.output):
+      parser.error("--renditions can not be written to stdout")
+    heights = args.renditions.split(",")
+    if not all(x.strip().isdigit() and int(x) > 0 for x in heights):
+      parser.error("--renditions expects a comma separated list of" +\
+          f" heights in pixels, e.g. 1080,720, not \"{args.renditions}\"")
+    renditions = [int(x) for x in heights]
+  if args.hls:
+    if not args.renditions:
+      parser.error("--hls requires --renditions")
+    hls = True
+  if args.in_process_remux:
+    if helper.import_av() is None:
+      parser.error("--in-process-remux requires PyAV (pip install av)")
+    in_process_remux = True
+  if args.detector:
+    detector = args.detector
+  if args.snap_tolerance:
+    snap_tolerance = args.snap_tolerance
+  if args.piece_cache:
+    piece_cache = args.piece_cache
+  if args.workers:
+    workers = [distributed.parse_address(x)
+        for x in args.workers.split(",")]
 
   if args.invert and not args.aggressiveness:
     aggressiveness = 1
@@ -421,15 +1208,61 @@ def get_automatic_name_insert():
 
   if invert:
     automatic_name_insert = "_inverted" + automatic_name_insert
+  if preview:
+    automatic_name_insert = automatic_name_insert[:-1] + "_preview."
 
   return automatic_name_insert
 
+def get_settings(cut_list=None):
+  """
+  Get the settings that influence the output.
+  An output is only up to date if it was produced with the same settings.
+
+  cut_list -- the cut list file used for the output, if any
+  """
+  return {
+    "cut_list": hash_cut_list(cut_list),
+    "invert": invert,
+    "quality": quality,
+    "aggressiveness": aggressiveness,
+    "reencode": reencode,
+    "parallel_reencode": parallel_reencode,
+    "detector": detector,
+    "snap_tolerance": snap_tolerance,
+    "renditions": renditions,
+    "hls": hls,
+    "preview": preview,
+    "timecode": timecode,
+  }
+
+def get_cut_list_path(args, input_file):
+  """
+  Get the file the cut list of the given input is loaded from or saved
+  to, or None if no cut list file is used.
+
+  args -- the command line arguments
+  input_file -- the input file
+  """
+  name = os.path.splitext(os.path.basename(input_file))[0] + CUT_LIST_SUFFIX
+  if args.cuts:
+    if os.path.isdir(args.input):
+      os.makedirs(args.cuts, exist_ok=True)
+      return os.path.join(args.cuts, name)
+    return args.cuts
+  if preview and input_file != "-":
+    return os.path.join(os.path.dirname(input_file), name)
+  return None
+
 def process_files_in_dir(args):
   get_file_path = lambda x: x
   if args.output:
     if not os.path.isdir(args.output):
       os.mkdir(args.output)
     get_file_path = lambda x: os.path.join(args.output, os.path.basename(x))
+    if preview:
+      # never overwrite the full renders in the same directory
+      get_file_path = lambda x: os.path.join(args.output,
+          "_preview".join(os.path.splitext(os.path.basename(x))))
   else:
     get_file_path = lambda x: os.path.splitext(os.path.basename(x))[0] +\
         get_automatic_name_insert() +\
@@ -438,9 +1271,28 @@ def process_files_in_dir(args):
   files = sorted(os.listdir(args.input))
   files = [f for f in files if os.path.isfile(os.path.join(args.input, f))]
   files = [os.path.join(args.input, f) for f in files]
-  # TODO: Check if files are actually videos
+  skipped = [f for f in files if not is_media_file(f)]
+  files = [f for f in files if f not in skipped]
+  if len(skipped) > 0:
+    rich.print(f"\nSkipping [cyan]{len(skipped)}[/cyan] non-media" +\
+        f" file{'s' if len(skipped) > 1 else ''}:")
+    for f in skipped:
+      rich.print(f"  [yellow]{f}[/yellow]")
   files = [(x, get_file_path(x)) for x in files]
-  
+
+  # an edited cut list makes the output outdated
+  get_file_settings = lambda x: get_settings(get_cut_list_path(args, x))
+  if not args.force:
+    up_to_date = [x for x in files
+        if is_up_to_date(x[0], x[1], get_file_settings(x[0]))]
+    files = [x for x in files if x not in up_to_date]
+    if len(up_to_date) > 0:
+      rich.print(f"\nSkipping [cyan]{len(up_to_date)}[/cyan] up to date" +\
+          f" file{'s' if len(up_to_date) > 1 else ''}")
+  if len(files) <= 0:
+    rich.print("\n[bold green]Everything is up to date.\n")
+    return
+
   file_progress = Progress(
       "[progress.description]{task.description}",
       BarColumn(bar_width=None),
@@ -452,6 +1304,7 @@ def process_files_in_dir(args):
 
   group = Group(file_progress)
 
+  results = []
   start = time.perf_counter()
   with Live(group):
     pbar = file_progress.add_task("[yellow]Videos", total=len(files))
@@ -459,10 +1312,15 @@ def process_files_in_dir(args):
     for input_file, output_file in files:
       prog = generate_progress_instance()
       group.renderables.insert(0, prog)
-      run(prog, {
+      outputs = run(prog, {
         "file": input_file,
-        "output": output_file
+        "output": output_file,
+        "cut_list": get_cut_list_path(args, input_file),
+        "load_cut_list": bool(args.cuts),
       })
+      write_manifest(input_file, output_file, get_file_settings(input_file),
+          outputs)
+      results += [(input_file, x) for x in outputs]
       file_progress.update(pbar, advance=1)
       group.renderables.remove(prog)
       rich.print(prog)
@@ -472,15 +1330,44 @@ def process_files_in_dir(args):
 
   end = time.perf_counter()
 
-  print_stats(files, end - start)
+  print_results(results, len(files), end - start)
+
+def print_results(results, n_files, total_time):
+  """
+  Print the stats of the produced outputs. Outputs that are not media
+  files, like HLS playlists or stdout, are left out.
+
+  results -- a list of (input file, output file) tuples
+  n_files -- the number of processed input files
+  total_time -- the processing time in seconds
+  """
+  results = [x for x in results if is_media_file(x[0]) and is_media_file(x[1])]
+  if len(results) > 0:
+    print_stats(results, total_time)
+  else:
+    print_performance(n_files, total_time)
+  # audio only files and previews never create the pool
+  if pool is not None:
+    print_pool_stats(pool.stats())
 
 def main():
   """
   Main function.
   """
   args = parse_args()
+  if args.input == "-" and args.output == None:
+    args.output = "-"
+  # keep stdout free for the video
+  if args.output == "-":
+    rich.reconfigure(stderr=True)
   greetings()
 
+  if args.worker:
+    address = distributed.parse_address(args.worker)
+    rich.print(f"\nWorker listening on [yellow]{args.worker}[/yellow]")
+    distributed.serve(address, max(1, cores // CORES_PER_WORKER))
+    return
+
   # because windows is seemingly designed by a 5 year old
   # we need to replace trailing double quotes with a backslash
   # ( see https://bugs.python.org/msg364246 )
@@ -496,13 +1383,15 @@ def main():
 
     start = time.perf_counter()
     with generate_progress_instance() as progress:
-      run(progress, {
+      outputs = run(progress, {
         "file": args.input,
-        "output": args.output
+        "output": args.output,
+        "cut_list": get_cut_list_path(args, args.input),
+        "load_cut_list": bool(args.cuts),
       })
       end = time.perf_counter()
 
-    print_stats([(args.input, args.output)], end - start)
+    print_results([(args.input, x) for x in outputs], 1, end - start)
 
 def shotdown_cleanup():
   """
@@ -0,0 +1,57 @@
+import json
+import os
+
+from piececache import fingerprint
+
+MANIFEST_SUFFIX = ".lecturecut.json"
+
+
+def manifest_path(output):
+  """
+  Get the path of the manifest that belongs to the given output file.
+
+  output -- the path of the output file
+  """
+  return output + MANIFEST_SUFFIX
+
+
+def is_up_to_date(input, output, settings):
+  """
+  Check whether the output was produced from the current input with the
+  same settings. This is the case if the manifest next to the output
+  records the fingerprint of the input and the settings.
+
+  input -- the path of the input file
+  output -- the path of the output file
+  settings -- a JSON serializable dictionary of the settings
+  """
+  if not os.path.isfile(manifest_path(output)):
+    return False
+  try:
+    with open(manifest_path(output)) as f:
+      manifest = json.load(f)
+  except (OSError, ValueError):
+    return False
+  # compare the cheap parts first to avoid reading the input
+  if manifest.get("settings") != settings:
+    return False
+  if not all(os.path.exists(x) for x in manifest.get("outputs", [output])):
+    return False
+  return manifest.get("input") == fingerprint(input)
+
+
+def write_manifest(input, output, settings, outputs=None):
+  """
+  Record the fingerprint of the input and the settings next to the output.
+
+  input -- the path of the input file
+  output -- the path of the output file
+  settings -- a JSON serializable dictionary of the settings
+  outputs -- all files produced for the output, e.g. the renditions
+  """
+  with open(manifest_path(output), "w") as f:
+    json.dump({
+      "input": fingerprint(input),
+      "settings": settings,
+      "outputs": outputs if outputs is not None else [output],
+    }, f, indent=2)
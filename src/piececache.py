@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+
+def fingerprint(path, with_mtime=True):
+  """
+  Get a cheap fingerprint of the given file.
+  Only the size, the modification time and the first and last block of
+  the file are hashed, so this is fast even for large videos on slow
+  storage.
+
+  path -- the path to the file
+  with_mtime -- include the modification time, leave it out for files
+                that are rewritten with the same content on every run
+  """
+  stat = os.stat(path)
+  size = stat.st_size
+  digest = hashlib.sha1((f"{size}:{stat.st_mtime_ns}" if with_mtime
+      else str(size)).encode())
+  with open(path, "rb") as f:
+    digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    if size > FINGERPRINT_BLOCK_SIZE:
+      f.seek(max(FINGERPRINT_BLOCK_SIZE, size - FINGERPRINT_BLOCK_SIZE))
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+def _link_or_copy(source, destination):
+  """
+  Hard link the source to the destination, copy if linking fails.
+
+  source -- the existing file
+  destination -- the path of the new file
+  """
+  try:
+    os.link(source, destination)
+  except OSError:
+    shutil.copyfile(source, destination)
+
+
+class PieceCache(object):
+  """
+  Stores rendered pieces between runs, so that a re-render with a
+  slightly different cut list only has to produce the changed pieces.
+  Pieces are keyed by the source file, the segment, the keep range and
+  the encoder settings used to produce them.
+  """
+
+  def __init__(self, path, source):
+    """
+    path -- the directory the pieces are stored in
+    source -- the fingerprint of the input file the pieces are cut from
+    """
+    self.path = path
+    self.source = source
+    os.makedirs(path, exist_ok=True)
+
+  def key(self, index, segment, trim, settings):
+    """
+    Get the cache key of a piece.
+
+    index -- the segment number
+    segment -- the segment start end map
+    trim -- the (start, end) keep range in segment time
+    settings -- the encoder settings used to render the piece
+    """
+    data = json.dumps([
+      self.source,
+      index,
+      round(segment["start"], 5),
+      round(segment["end"], 5),
+      round(trim[0], 5),
+      round(trim[1], 5),
+      settings,
+    ])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.path, key + ".ts")
+
+  def fetch(self, key, destination):
+    """
+    Place the cached piece at the destination.
+
+    key -- the cache key of the piece
+    destination -- the path the piece should be placed at
+
+    returns True if the piece was cached.
+    """
+    if not os.path.isfile(self._path(key)):
+      return False
+    _link_or_copy(self._path(key), destination)
+    return True
+
+  def store(self, key, source):
+    """
+    Add a rendered piece to the cache.
+
+    key -- the cache key of the piece
+    source -- the path of the rendered piece
+    """
+    # write to a temporary name first so that concurrent runs never see
+    # a partially written piece
+    tmp = os.path.join(self.path, f".{uuid.uuid4()}.tmp")
+    _link_or_copy(source, tmp)
+    os.replace(tmp, self._path(key))
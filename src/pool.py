@@ -0,0 +1,158 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+
+POLL_INTERVAL = 0.05
+
+
+def run_in_thread(fn, *args):
+  """
+  Call fn with the given arguments in a new thread, outside of any pool.
+  Meant for long running stages that mostly wait for other work, so they
+  do not hold a worker of the pool.
+
+  returns a Future for the result.
+  """
+  future = Future()
+
+  def _run():
+    try:
+      future.set_result(fn(*args))
+    except BaseException as e:
+      future.set_exception(e)
+
+  threading.Thread(target=_run, daemon=True).start()
+  return future
+
+
+class WorkerPool(object):
+  """
+  A pool of worker threads that lives for the whole session and is
+  shared by all stages and files. The heavy lifting is done by ffmpeg
+  processes and C extensions, so threads are sufficient.
+  Stages may submit work from inside the pool. While a worker waits for
+  such work, it runs queued tasks itself, so nesting can not deadlock.
+  """
+
+  def __init__(self, workers):
+    """
+    workers -- the number of worker threads
+    """
+    self.workers = workers
+    self._tasks = queue.Queue()
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._running = 0
+    self._completed = 0
+    self._busy_time = 0.0
+    self._peak_queue_depth = 0
+    self._started = time.perf_counter()
+    self._threads = [threading.Thread(target=self._work, daemon=True)
+        for _ in range(workers)]
+    for thread in self._threads:
+      thread.start()
+
+  def _work(self):
+    self._local.is_worker = True
+    # time spent in wait(), which is not counted as busy
+    self._local.waited = 0.0
+    for task in iter(self._tasks.get, None):
+      self._run(task)
+
+  def _run(self, task):
+    fn, args, future = task
+    if not future.set_running_or_notify_cancel():
+      return
+    with self._lock:
+      self._running += 1
+    start = time.perf_counter()
+    waited = self._local.waited
+    try:
+      future.set_result(fn(*args))
+    except BaseException as e:
+      future.set_exception(e)
+    finally:
+      busy = time.perf_counter() - start - (self._local.waited - waited)
+      with self._lock:
+        self._running -= 1
+        self._completed += 1
+        self._busy_time += busy
+
+  def submit(self, fn, *args):
+    """
+    Queue a call of fn with the given arguments.
+
+    returns a Future for the result.
+    """
+    future = Future()
+    self._tasks.put((fn, args, future))
+    with self._lock:
+      self._peak_queue_depth = max(self._peak_queue_depth,
+          self._tasks.qsize())
+    return future
+
+  def wait(self, futures):
+    """
+    Wait for the given futures.
+    When called from a worker, queued tasks are run while waiting.
+
+    returns the list of results, raises the first exception.
+    """
+    if not getattr(self._local, "is_worker", False):
+      wait(futures)
+      return [x.result() for x in futures]
+    start = time.perf_counter()
+    waited = self._local.waited
+    for future in futures:
+      while not future.done():
+        try:
+          task = self._tasks.get_nowait()
+        except queue.Empty:
+          wait([future], timeout=POLL_INTERVAL)
+          continue
+        if task is None:
+          # keep the shutdown signal for an idle worker
+          self._tasks.put(None)
+          wait([future])
+          break
+        self._run(task)
+    # tasks run while waiting account for their own time
+    self._local.waited = waited + time.perf_counter() - start
+    return [x.result() for x in futures]
+
+  def map(self, fn, iterable):
+    """
+    Call fn for every item and wait for all results.
+
+    returns the list of results in the order of the items.
+    """
+    return self.wait([self.submit(fn, x) for x in iterable])
+
+  def stats(self):
+    """
+    Get the current load of the pool.
+
+    returns a dict with the number of workers, the queue depth, the peak
+    queue depth, the running and completed tasks and the utilization,
+    the share of worker time spent running tasks since the pool started.
+    """
+    with self._lock:
+      elapsed = time.perf_counter() - self._started
+      return {
+        "workers": self.workers,
+        "queue_depth": self._tasks.qsize(),
+        "peak_queue_depth": self._peak_queue_depth,
+        "running": self._running,
+        "completed": self._completed,
+        "utilization": self._busy_time / max(elapsed * self.workers, 1e-9),
+      }
+
+  def shutdown(self):
+    """
+    Stop the workers after the queued tasks are done.
+    """
+    for _ in self._threads:
+      self._tasks.put(None)
+    for thread in self._threads:
+      thread.join()
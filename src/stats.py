@@ -48,10 +48,30 @@ def print_stats(files, total_time):
       f"{total_output_length / total_input_length * 100:.2f} %"
     )
 
-  performance = f"[bold green]Processed [bold cyan]{len(files)} [bold green]video{'s' if len(files) > 1 else ''} in [bold cyan]{total_time / 60:.0f} [bold green]min and [bold cyan]{total_time % 60:.0f} [bold green]sec."
-  
   rich.print()
   rich.print(Align(table, align="center"))
+  print_performance(len(set(x[0] for x in files)), total_time)
+
+def print_performance(n_files, total_time):
+  """
+  Print how long it took to process the given number of files.
+
+  n_files -- The number of processed input files.
+  total_time -- The processing time in seconds.
+  """
+  performance = f"[bold green]Processed [bold cyan]{n_files} [bold green]video{'s' if n_files > 1 else ''} in [bold cyan]{total_time / 60:.0f} [bold green]min and [bold cyan]{total_time % 60:.0f} [bold green]sec."
+
   rich.print()
   rich.print(Align(performance, align="center"))
-  rich.print()
\ No newline at end of file
+  rich.print()
+
+def print_pool_stats(stats):
+  """
+  Print how well the worker pool kept the machine busy.
+
+  stats -- The stats of the worker pool.
+  """
+  pool = f"[bold green]Worker pool: [bold cyan]{stats['workers']} [bold green]workers at [bold cyan]{stats['utilization'] * 100:.1f} % [bold green]utilization, peak queue depth [bold cyan]{stats['peak_queue_depth']}[bold green]."
+
+  rich.print(Align(pool, align="center"))
+  rich.print()
@@ -1,10 +1,14 @@
 import math
 
-import cv2
 import ffmpeg
+import numpy as np
 import webrtcvad
 
+from helper import get_video_length
+
 KERN_SIZE = 30
+SAMPLE_RATE = 16000
+FRAME_DURATION_MS = 30
 
 def read_audio(path):
   """
@@ -15,23 +19,72 @@ def read_audio(path):
   out, _ = (
     ffmpeg
     .input(path)
-    .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar="16k")
+    .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1,
+        ar=SAMPLE_RATE)
     .global_args("-loglevel", "quiet")
     .global_args("-hide_banner")
     .global_args("-nostdin")
     .run(capture_stdout=True)
   )
-  return out, 16000
+  return out, SAMPLE_RATE
 
 
 class Frame(object):
   """Represents a "frame" of audio data."""
+  __slots__ = ("bytes", "timestamp", "duration")
+
   def __init__(self, bytes, timestamp, duration):
     self.bytes = bytes
     self.timestamp = timestamp
     self.duration = duration
 
 
+class FrameBuffer(object):
+  """
+  Fixed size audio frames backed by a single PCM buffer.
+  Frames are addressed by their index. The byte offset and the timestamp
+  of a frame are computed from the index, so no per frame data is stored
+  and no audio is copied.
+  """
+  __slots__ = ("audio", "sample_rate", "frame_size", "duration", "count")
+
+  def __init__(self, frame_duration_ms, audio, sample_rate):
+    """
+    frame_duration_ms -- The frame duration in milliseconds.
+    audio -- The PCM data (16 bit mono).
+    sample_rate -- The sample rate of the data.
+    """
+    self.audio = memoryview(audio)
+    self.sample_rate = sample_rate
+    self.frame_size = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+    self.duration = (float(self.frame_size) / sample_rate) / 2.0
+    # only full frames that are followed by more data are used
+    self.count = max(0, (len(audio) - 1) // self.frame_size)
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.count
+    if not 0 <= i < self.count:
+      raise IndexError("frame index out of range")
+    return Frame(self.bytes(i), self.timestamp(i), self.duration)
+
+  def offset(self, i):
+    """Byte offset of frame i in the PCM buffer."""
+    return i * self.frame_size
+
+  def bytes(self, i):
+    """Zero-copy view on the PCM data of frame i."""
+    offset = i * self.frame_size
+    return self.audio[offset:offset + self.frame_size]
+
+  def timestamp(self, i):
+    """Start of frame i in seconds."""
+    return i * self.duration
+
+
 def frame_generator(frame_duration_ms, audio, sample_rate):
   """
   Generates audio frames from PCM audio data.
@@ -43,14 +96,102 @@ def frame_generator(frame_duration_ms, audio, sample_rate):
   audio -- The PCM data.
   sample_rate -- The sample rate of the data.
   """
-  n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
-  offset = 0
-  timestamp = 0.0
-  duration = (float(n) / sample_rate) / 2.0
-  while offset + n < len(audio):
-    yield Frame(audio[offset:offset + n], timestamp, duration)
-    timestamp += duration
-    offset += n
+  frames = FrameBuffer(frame_duration_ms, audio, sample_rate)
+  for i in range(len(frames)):
+    yield frames[i]
+
+
+class Detector(object):
+  """
+  Interface of the speech detector backends.
+  A detector scores every frame of a FrameBuffer with the probability
+  of it containing speech. Smoothing and merging of the scores into
+  segments is done by vad_collector.
+  """
+
+  def scores(self, frames):
+    """
+    Score the frames of the given FrameBuffer.
+
+    frames -- a FrameBuffer holding the audio.
+
+    returns -- a list with one score between 0 and 1 per frame.
+    """
+    raise NotImplementedError
+
+
+class WebRTCDetector(Detector):
+  """Scores frames with WebRTC's VAD."""
+
+  def __init__(self, aggressiveness):
+    self.vad = webrtcvad.Vad(aggressiveness)
+
+  def scores(self, frames):
+    return [float(self.vad.is_speech(frames.bytes(i), frames.sample_rate))
+        for i in range(len(frames))]
+
+
+class EnergyDetector(Detector):
+  """
+  Scores frames by their energy relative to an adaptive noise floor.
+  The noise floor is a low percentile of the frame energies of blocks
+  of a few seconds, so it follows slow changes of the background noise.
+  All computations are vectorized with NumPy.
+  """
+  # required distance to the noise floor in dB, indexed by aggressiveness
+  THRESHOLDS = (6.0, 9.0, 12.0, 15.0)
+  FLOOR_BLOCK_SIZE = 334 # frames, roughly 10 seconds
+  FLOOR_PERCENTILE = 10
+  CHUNK_SIZE = 1 << 14 # frames converted to float at once
+
+  def __init__(self, aggressiveness):
+    self.threshold = self.THRESHOLDS[aggressiveness]
+
+  def energies(self, frames):
+    """
+    Calculate the energy of every frame in dB.
+
+    frames -- a FrameBuffer holding the audio.
+    """
+    n = len(frames)
+    samples_per_frame = frames.frame_size // 2
+    samples = np.frombuffer(frames.audio, dtype="<i2",
+        count=n * samples_per_frame).reshape(n, samples_per_frame)
+    energy = np.empty(n)
+    for start in range(0, n, self.CHUNK_SIZE):
+      chunk = samples[start:start + self.CHUNK_SIZE].astype(np.float32)
+      energy[start:start + self.CHUNK_SIZE] = np.mean(chunk ** 2, axis=1)
+    return 10 * np.log10(energy + 1.0)
+
+  def noise_floor(self, energy):
+    """
+    Estimate the noise floor for every frame.
+
+    energy -- the frame energies in dB.
+    """
+    blocks = np.array_split(energy,
+        max(1, len(energy) // self.FLOOR_BLOCK_SIZE))
+    floors = np.array([np.percentile(x, self.FLOOR_PERCENTILE)
+        for x in blocks])
+    # a block without pauses must not raise the floor to speech level
+    padded = np.pad(floors, 1, mode="edge")
+    floors = np.minimum(np.minimum(padded[:-2], padded[1:-1]), padded[2:])
+    sizes = np.array([len(x) for x in blocks])
+    centers = np.cumsum(sizes) - sizes / 2
+    return np.interp(np.arange(len(energy)), centers, floors)
+
+  def scores(self, frames):
+    if len(frames) == 0:
+      return []
+    energy = self.energies(frames)
+    speech = energy > self.noise_floor(energy) + self.threshold
+    return speech.astype(float).tolist()
+
+
+DETECTORS = {
+  "webrtc": WebRTCDetector,
+  "energy": EnergyDetector,
+}
 
 
 def build_gauss_kernel(n_frames):
@@ -91,25 +232,22 @@ def clip_gauss_kernel(kernel, side, cutoff):
   kernel = [x / kernelSum for x in kernel]
   return kernel
 
-def vad_collector(sample_rate, frame_duration_ms, kernel_size, vad, frames):
+def vad_collector(kernel_size, detector, frames):
   """
   Filters out non-voiced audio frames.
-  Given a webrtcvad.Vad and a source of audio frames, returns a list
+  Given a Detector and a FrameBuffer, returns a list
   of (start, end) timestamps for the voiced audio.
   Uses a Gaussian filter to smooth the probability of being voiced
   over time.
   
   Arguments:
-  sample_rate -- The audio sample rate, in Hz.
-  frame_duration_ms -- The frame duration in milliseconds.
   kernel_size -- The number of frames to include in the smoothing per side.
-  vad -- An instance of webrtcvad.Vad.
-  frames -- a source of audio frames (sequence or generator).
+  detector -- An instance of a Detector.
+  frames -- a FrameBuffer holding the audio.
   
   returns -- a list of (start, end) timestamps.
   """
-  vad_frames = [(frame, vad.is_speech(frame.bytes, sample_rate))
-                for frame in frames]
+  vad_frames = list(enumerate(detector.scores(frames)))
 
   kernel = build_gauss_kernel(kernel_size * 2 + 1)
   filtered_vad_frames = []
@@ -133,7 +271,7 @@ def vad_collector(sample_rate, frame_duration_ms, kernel_size, vad, frames):
           zip(vad_frames[i-kernel_size : i+kernel_size+1], kernel)
           ])))
 
-  segments = [(x[0].timestamp, x[0].timestamp+x[0].duration)
+  segments = [(frames.timestamp(x[0]), frames.timestamp(x[0] + 1))
       for x in
       filtered_vad_frames if x[1] > 0.5]
   # merge segments when no more than .2 second between them
@@ -151,7 +289,7 @@ def vad_collector(sample_rate, frame_duration_ms, kernel_size, vad, frames):
 
   return newSegments
 
-def run(file, aggressiveness, invert=False):
+def run(file, aggressiveness, invert=False, audio=None, detector="webrtc"):
   """
   Given a file path, aggressiveness, and invert flag, returns a list of
   (start, end) timestamps for the voiced audio.
@@ -160,19 +298,21 @@ def run(file, aggressiveness, invert=False):
   aggressiveness: aggressiveness of the VAD
   invert: if True, returns a list of (start, end) timestamps
           for the non-voiced audio
+  audio: PCM data (16 bit mono at SAMPLE_RATE) that was already decoded
+         from the file. If None, the audio is read from the file.
+  detector: name of the speech detector backend, a key of DETECTORS
   """
-  audio, sample_rate = read_audio(file)
-  vad = webrtcvad.Vad(aggressiveness)
-  frames = frame_generator(30, audio, sample_rate)
-  frames = list(frames)
-  segments = vad_collector(sample_rate, 30, KERN_SIZE, vad, frames)  
+  if audio is None:
+    audio, sample_rate = read_audio(file)
+  else:
+    sample_rate = SAMPLE_RATE
+  detector = DETECTORS[detector](aggressiveness)
+  frames = FrameBuffer(FRAME_DURATION_MS, audio, sample_rate)
+  segments = vad_collector(KERN_SIZE, detector, frames)
   cuts = segments
 
   if invert:
-    video = cv2.VideoCapture(file)
-    fps = video.get(cv2.CAP_PROP_FPS)
-    frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
-    duration = frame_count / fps
+    duration = get_video_length(file)
     cuts = []
     if segments[0][0] > 0:
       cuts.append((0, segments[0][0]))
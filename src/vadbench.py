@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+import rich
+from rich.align import Align
+from rich.table import Table
+
+import vad
+
+REFERENCE = "webrtc"
+
+
+def kept_duration(segments):
+  """
+  Get the total duration of the given (start, end) segments.
+
+  segments -- the segments
+  """
+  return sum(x[1] - x[0] for x in segments)
+
+
+def overlap(a, b):
+  """
+  Get the duration that is covered by both lists of segments.
+
+  a -- sorted, non overlapping (start, end) segments
+  b -- sorted, non overlapping (start, end) segments
+  """
+  i = j = 0
+  total = 0
+  while i < len(a) and j < len(b):
+    total += max(0, min(a[i][1], b[j][1]) - max(a[i][0], b[j][0]))
+    if a[i][1] < b[j][1]:
+      i += 1
+    else:
+      j += 1
+  return total
+
+
+def benchmark(file, aggressiveness):
+  """
+  Run all detectors on the audio of the given file.
+
+  file -- the file to analyse
+  aggressiveness -- the aggressiveness passed to the detectors
+
+  returns a dict mapping detector names to
+  (scoring time, total time, frame scores, segments).
+  """
+  audio, sample_rate = vad.read_audio(file)
+  frames = vad.FrameBuffer(vad.FRAME_DURATION_MS, audio, sample_rate)
+  results = {}
+  for name, backend in vad.DETECTORS.items():
+    detector = backend(aggressiveness)
+    start = time.perf_counter()
+    scores = detector.scores(frames)
+    scored = time.perf_counter()
+    segments = vad.vad_collector(vad.KERN_SIZE, detector, frames)
+    end = time.perf_counter()
+    # vad_collector scores the frames again, so it covers the whole run
+    results[name] = (scored - start, end - scored, scores, segments)
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Compare the speed and the results of the speech"+\
+          " detector backends against WebRTC's VAD.")
+  parser.add_argument(
+      "files",
+      help="The audio or video files to analyse",
+      nargs="+")
+  parser.add_argument(
+      "-a", "--aggressiveness",
+      help="The aggressiveness of the detectors. Default: 3",
+      type=int,
+      default=3)
+  args = parser.parse_args()
+
+  table = Table(title="Detector Benchmark")
+  table.add_column("File", justify="left", style="yellow")
+  table.add_column("Detector", justify="left", style="plum4")
+  table.add_column("Scoring", justify="right", style="cyan")
+  table.add_column("Total", justify="right", style="cyan")
+  table.add_column("Frame Agreement", justify="right", style="magenta")
+  table.add_column("Kept Overlap", justify="right", style="magenta")
+
+  for file in args.files:
+    results = benchmark(file, args.aggressiveness)
+    _, _, ref_scores, ref_segments = results[REFERENCE]
+    for name, (scoring, total, scores, segments) in results.items():
+      agreeing = sum((x > .5) == (y > .5)
+          for x, y in zip(scores, ref_scores))
+      # intersection over union of the kept time
+      common = overlap(segments, ref_segments)
+      union = kept_duration(segments) + kept_duration(ref_segments) - common
+      table.add_row(
+        file,
+        name,
+        f"{scoring:.2f} s",
+        f"{total:.2f} s",
+        f"{agreeing / max(len(ref_scores), 1) * 100:.2f} %",
+        f"{common / union * 100 if union else 100:.2f} %",
+      )
+
+  rich.print()
+  rich.print(Align(table, align="center"))
+  rich.print()
+
+
+if __name__ == "__main__":
+  main()